@@ -47,6 +47,7 @@ from mathutils import Vector
 from mathutils.bvhtree import BVHTree
 from timeit import default_timer as timer
 from sys import float_info
+import numpy
 
 
 # Logging
@@ -171,20 +172,60 @@ class DebrisGraph:
         self.detectDisconnected = detectDiscon
 
         self.pieceList = []
-        self.pieceGraph = {}
-        self.bottomPieces = set()
-        self.crumbleSet = set()
+
+        # name <-> index map; all graph state below is keyed by piece index
+        self.pieceNames = []
+        self.pieceIndex = {}
+
+        # connection graph in CSR form: the neighbours of piece i are
+        # graphNeighbors[graphOffsets[i]:graphOffsets[i + 1]]
+        self.graphOffsets = numpy.zeros(1, dtype=numpy.int32)
+        self.graphNeighbors = numpy.zeros(0, dtype=numpy.int32)
+
+        # per-piece flags, indexed by piece number
+        self.bottomMask = numpy.zeros(0, dtype=bool)
+        self.crumbledMask = numpy.zeros(0, dtype=bool)
+
+        # plain Python copies of the graph for the per-frame search; indexing NumPy arrays
+        # one element at a time from Python is much slower than lists and bytearrays
+        self._searchNeighbors = []
+        self._searchBottom = bytearray()
+        self._searchCrumbled = bytearray()
+        self._searchVisited = bytearray()
 
 
     # Public Methods
     
     def addList(self, list):
+        if not self._hasPieceObjects():
+            errorPrint("Cannot add pieces to a debris graph restored from arrays.")
+            return
+
         for item in list:
+            if item.name in self.pieceIndex:
+                debugPrint("Skipping duplicate piece:" + item.name)
+                continue
+
+            self.pieceIndex[item.name] = len(self.pieceNames)
+            self.pieceNames.append(item.name)
             self.pieceList.append(item)
+
+        # new pieces start out neither base nor crumbled; the graph needs recomputing
+        count = len(self.pieceNames)
+        added = numpy.zeros(count - len(self.crumbledMask), dtype=bool)
+        self.bottomMask = numpy.concatenate((self.bottomMask, added))
+        self.crumbledMask = numpy.concatenate((self.crumbledMask, added))
+        self.graphOffsets = numpy.zeros(count + 1, dtype=numpy.int32)
+        self.graphNeighbors = numpy.zeros(0, dtype=numpy.int32)
+        self._refreshSearchCache()
         
         
     def compute(self):
-        if self.detectDisconnected:        
+        if not self._hasPieceObjects():
+            errorPrint("Cannot recompute a debris graph restored from arrays.")
+            return
+
+        if self.detectDisconnected and self.pieceList:
             # find bottommost pieces and compute connection graph
             def minZSorter(p):
                 return p[1]
@@ -192,56 +233,72 @@ class DebrisGraph:
             # by sorting by height, we will search downward first, which should get us to a
             # base piece sooner        
             heightSorted = []
-            for piece in self.pieceList:
-                heightSorted.append((piece, GeoUtil.computeMeshMinZ(piece)))
+            for index, piece in enumerate(self.pieceList):
+                heightSorted.append((index, GeoUtil.computeMeshMinZ(piece)))
             heightSorted.sort(key=minZSorter)
 
             for sortPiece in heightSorted:
-                debugPrint("HeightSorted:" + sortPiece[0].name)
+                debugPrint("HeightSorted:" + self.pieceNames[sortPiece[0]])
             
             bottomZ = heightSorted[0][1]
             for sortPiece in heightSorted:
                 if sortPiece[1] - bottomZ > 0.001:
                     break
                 else:
-                    self.bottomPieces.add(sortPiece[0])
+                    self.bottomMask[sortPiece[0]] = True
 
-            debugPrint("Bottom piece count: " + str(len(self.bottomPieces)))
+            debugPrint("Bottom piece count: " + str(numpy.count_nonzero(self.bottomMask)))
                     
             infoPrint("Computing connection graph...")
             start = timer()
-            index = 0            
+
+            # build per-piece adjacency first, then pack it into CSR arrays
+            count = len(self.pieceList)
+            adjacency = [None] * count
+            adjacencySets = [None] * count
+            progress = 0
             for piecePair in heightSorted:
-                piece = piecePair[0]
+                pieceIdx = piecePair[0]
+                piece = self.pieceList[pieceIdx]
 
-                index += 1
-                debugPrint ("  Piece:" + piece.name + " progress:" + str(index) + "/" + str(len(heightSorted)))
+                progress += 1
+                debugPrint ("  Piece:" + piece.name + " progress:" + str(progress) + "/" + str(len(heightSorted)))
 
                 touching = []
                 for otherPair in heightSorted:
-                    other = otherPair[0]
-                    if piece != other:
-                        found = False
-
-                        # optimization: we can use previous computations to cut our time
-                        if other in self.pieceGraph:
-                            otherList = self.pieceGraph[other]
-                            if piece in otherList:
-                                found = True
-                                
-                        if not found:
+                    otherIdx = otherPair[0]
+                    if pieceIdx != otherIdx:
+                        # optimization: a pair already tested from the other side doesn't need
+                        # another vertex comparison
+                        if adjacencySets[otherIdx] is not None:
+                            found = pieceIdx in adjacencySets[otherIdx]
+                        else:
+                            other = self.pieceList[otherIdx]
                             max = 4
                             tolerance = 0.01
                             common = GeoUtil.countCommonVerts(piece, other, tolerance, max)
                             debugPrint ("    Testing:" + other.name + " Common:" + str(common));
-                            if common >= max:
-                                found = True
+                            found = common >= max
 
                         if found:
                             debugPrint ("    Touching!");
-                            touching.append(other)
+                            touching.append(otherIdx)
 
-                self.pieceGraph[piece] = touching
+                # neighbours stay sorted by height
+                adjacency[pieceIdx] = touching
+                adjacencySets[pieceIdx] = set(touching)
+
+            offsets = numpy.zeros(count + 1, dtype=numpy.int32)
+            for pieceIdx in range(count):
+                offsets[pieceIdx + 1] = offsets[pieceIdx] + len(adjacency[pieceIdx])
+
+            neighbors = numpy.empty(offsets[-1], dtype=numpy.int32)
+            for pieceIdx in range(count):
+                neighbors[offsets[pieceIdx]:offsets[pieceIdx + 1]] = adjacency[pieceIdx]
+
+            self.graphOffsets = offsets
+            self.graphNeighbors = neighbors
+            self._refreshSearchCache()
                 
             # given this data structure, we can query whether the touching pieces are still
             # in the same place, and try to find a path from the current piece to a member 
@@ -252,51 +309,149 @@ class DebrisGraph:
     
     def isConnectedToBase(self, obj):
         if self.detectDisconnected:        
-            return self._isConnectedToBase_r(obj, set(), 0)
+            return self._isConnectedToBase(self.pieceIndex[obj.name])
         else:
             return not self.isCrumbled(obj)
 
 
     def isCrumbled(self, piece):
-        return piece in self.crumbleSet
+        index = self.pieceIndex.get(piece.name)
+        return index is not None and self._searchCrumbled[index] != 0
 
     
     def setCrumbled(self, piece):
-        self.crumbleSet.add(piece)        
+        index = self.pieceIndex[piece.name]
+        self.crumbledMask[index] = True
+        self._searchCrumbled[index] = 1
+
+
+    def toArrays(self):
+        # plain names and copied arrays only, so the graph can be saved or sent to another
+        # process without later changes showing up in the snapshot
+        return {
+            "names": list(self.pieceNames),
+            "offsets": self.graphOffsets.copy(),
+            "neighbors": self.graphNeighbors.copy(),
+            "bottom": self.bottomMask.copy(),
+            "crumbled": self.crumbledMask.copy(),
+        }
+
+
+    @classmethod
+    def fromArrays(cls, detectDiscon, arrays):
+        # a restored graph has no piece objects, so it is query-only: isConnectedToBase,
+        # isCrumbled and setCrumbled work, but it cannot be recomputed or extended
+        names = list(arrays["names"])
+        offsets = cls._indexArray(arrays["offsets"], "offsets")
+        neighbors = cls._indexArray(arrays["neighbors"], "neighbors")
+        bottom = cls._maskArray(arrays["bottom"], "bottom")
+        crumbled = cls._maskArray(arrays["crumbled"], "crumbled")
+
+        count = len(names)
+        if len(set(names)) != count:
+            raise ValueError("Debris graph piece names must be unique")
+        if offsets.ndim != 1 or neighbors.ndim != 1 or bottom.ndim != 1 or crumbled.ndim != 1:
+            raise ValueError("Debris graph arrays must be one-dimensional")
+        if len(bottom) != count or len(crumbled) != count or len(offsets) != count + 1:
+            raise ValueError("Debris graph arrays don't match piece count %d" % count)
+        if offsets[0] != 0 or offsets[-1] != len(neighbors) or numpy.any(numpy.diff(offsets) < 0):
+            raise ValueError("Debris graph offsets don't describe the neighbor array")
+        if len(neighbors) and (neighbors.min() < 0 or neighbors.max() >= count):
+            raise ValueError("Debris graph neighbors reference unknown pieces")
+
+        graph = cls(detectDiscon)
+        graph.pieceNames = names
+        graph.pieceIndex = {name: index for index, name in enumerate(names)}
+        graph.graphOffsets = offsets
+        graph.graphNeighbors = neighbors
+        graph.bottomMask = bottom
+        graph.crumbledMask = crumbled
+        graph._refreshSearchCache()
+        return graph
 
 
     # Private Methods
 
-    def _isConnectedToBase_r(self, obj, visited, level):
-        debugPrint(("  " * level) + "ICTB: " + obj.name)
-        if self._isBottomPiece(obj):
-            debugPrint(("  " * level) + "ICTB: BS: T")
-            return True
+    @staticmethod
+    def _indexArray(values, label):
+        array = numpy.asarray(values)
+        if array.size == 0:
+            return numpy.zeros(array.shape, dtype=numpy.int32)
 
-        if self.isCrumbled(obj) or obj in visited:
-            debugPrint(("  " * level) + "ICTB: CRV: F")
-            return False
+        if not numpy.issubdtype(array.dtype, numpy.integer):
+            raise ValueError("Debris graph %s must be integers, got %s" % (label, array.dtype))
 
-        visited.add(obj)    
+        limits = numpy.iinfo(numpy.int32)
+        if array.min() < limits.min or array.max() > limits.max:
+            raise ValueError("Debris graph %s don't fit in 32-bit integers" % label)
+
+        return array.astype(numpy.int32)
 
-        connList = self._getConnected(obj)
-        for connObj in connList:
-            debugPrint(("  " * level) + "ICTB: TST: " + obj.name + " > " + connObj.name)
-            if self._isConnectedToBase_r(connObj, visited, level + 1):
-                debugPrint(("  " * level) + "ICTB: IC!: T")
-                return True
-            
-        debugPrint(("  " * level) + "ICTB: F")
-        return False
+
+    @staticmethod
+    def _maskArray(values, label):
+        array = numpy.asarray(values)
+        if array.size == 0:
+            return numpy.zeros(array.shape, dtype=bool)
+
+        if array.dtype != bool:
+            raise ValueError("Debris graph %s must be booleans, got %s" % (label, array.dtype))
+
+        return array.copy()
+
+
+    def _refreshSearchCache(self):
+        offsets = self.graphOffsets.tolist()
+        neighbors = self.graphNeighbors.tolist()
+
+        # neighbours are stored reversed, so popping the search stack visits the lowest first
+        self._searchNeighbors = [neighbors[offsets[i]:offsets[i + 1]][::-1] for i in range(len(offsets) - 1)]
+        self._searchBottom = bytearray(self.bottomMask.tolist())
+        self._searchCrumbled = bytearray(self.crumbledMask.tolist())
+        self._searchVisited = bytearray(len(self.pieceNames))
+
+
+    def _isConnectedToBase(self, index):
+        # iterative depth-first search, so large structures can't hit the recursion limit
+        bottom = self._searchBottom
+        crumbled = self._searchCrumbled
+        visited = self._searchVisited
+        touched = []
+        found = False
+
+        stack = [index]
+        while stack:
+            current = stack.pop()
+            debugPrint("ICTB: " + self.pieceNames[current])
+            if bottom[current]:
+                debugPrint("ICTB: BS: T")
+                found = True
+                break
+
+            if crumbled[current] or visited[current]:
+                debugPrint("ICTB: CRV: F")
+                continue
+
+            visited[current] = 1
+            touched.append(current)
+
+            for connIdx in self._searchNeighbors[current]:
+                if not visited[connIdx]:
+                    debugPrint("ICTB: TST: " + self.pieceNames[current] + " > " + self.pieceNames[connIdx])
+                    stack.append(connIdx)
+
+        # clear only what this search marked, so the buffer can be reused without reallocating
+        for current in touched:
+            visited[current] = 0
+
+        if not found:
+            debugPrint("ICTB: F")
+        return found
 
         
     
-    def _getConnected(self, obj):
-        return self.pieceGraph[obj]
-    
-    
-    def _isBottomPiece(self, obj):
-        return obj in self.bottomPieces
+    def _hasPieceObjects(self):
+        return len(self.pieceList) == len(self.pieceNames)
 
                     
 class SmashingMain(Operator):
@@ -570,7 +725,7 @@ class SmashingMain(Operator):
                     
                     connToBase = pieceGraph.isConnectedToBase(piece)
                     if inHitSequence and not pieceGraph.isCrumbled(piece) and (not connToBase or distance < shockRadius or localOverlapPos != None):
-                        # turn off kinematic and add to crumbleSet
+                        # turn off kinematic and mark as crumbled
                         piece.rigid_body.kinematic = True
                         piece.keyframe_insert(data_path="rigid_body.kinematic", frame=frame-1)
                         piece.rigid_body.kinematic = False